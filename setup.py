@@ -5,6 +5,9 @@ from setuptools import setup
 setup (name = 'ugit',
     version = '1.0',
     packages = ['ugit'],
+    extras_require = {
+        'graph': ['pygraphviz']
+    },
     entry_points = {
         'console_scripts' : [
             'ugit = ugit.cli:main'
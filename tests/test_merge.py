@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+from ugit import base, data
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        self._git_dir = data.change_git_dir('.')
+        self._git_dir.__enter__()
+        base.init()
+
+    def tearDown(self):
+        self._git_dir.__exit__(None, None, None)
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def _write(self, files):
+        for filename, content in files.items():
+            os.makedirs(os.path.dirname(f'./{filename}'), exist_ok=True)
+            with open(filename, 'w') as f:
+                f.write(content)
+        base.add(list(files))
+
+    def _read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_merge_keeps_paths_that_sort_around_a_directory(self):
+        # Tree order puts the directory `a` before `a-b` and `a.txt`,
+        # while plain string order would put `a/b` after both
+        self._write({'a/b': 'base\n', 'a.txt': 'base\n', 'a-b': 'base\n'})
+        root = base.commit('base')
+        base.create_branch('topic', root)
+        self._write({'a.txt': 'main\n'})
+        base.commit('main')
+        base.checkout('topic')
+        self._write({'a/b': 'topic\n', 'a-b': 'topic\n'})
+        base.commit('topic')
+        base.checkout('main')
+
+        base.merge(base.get_oid('topic'))
+
+        self.assertEqual(self._read('a/b'), 'topic\n')
+        self.assertEqual(self._read('a.txt'), 'main\n')
+        self.assertEqual(self._read('a-b'), 'topic\n')
+        with data.get_index() as index:
+            self.assertEqual(sorted(index), ['a-b', 'a.txt', 'a/b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
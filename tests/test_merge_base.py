@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from ugit import base, data
+
+
+class MergeBaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        self._git_dir = data.change_git_dir('.')
+        self._git_dir.__enter__()
+        base.init()
+
+    def tearDown(self):
+        self._git_dir.__exit__(None, None, None)
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def _commit(self, filename, content):
+        with open(filename, 'w') as f:
+            f.write(content)
+        base.add([filename])
+        return base.commit(filename)
+
+    def test_merged_history_prefers_nearest_common_ancestor(self):
+        # R - M - H1 - H2 - MM   (main)
+        #  \               /
+        #   T1 ------------      (topic)
+        r = self._commit('r', 'r')
+        m = self._commit('m', 'm')
+        base.create_branch('topic', r)
+        self._commit('h', 'h1')
+        self._commit('h', 'h2')
+        base.checkout('topic')
+        self._commit('t', 't1')
+        base.checkout('main')
+        base.merge(base.get_oid('topic'))
+        main = base.commit('MM')
+
+        self.assertEqual(base.get_merge_base(m, main), m)
+        self.assertEqual(base.get_merge_base(main, m), m)
+        self.assertEqual(base.get_merge_base(r, main), r)
+
+
+if __name__ == '__main__':
+    unittest.main()
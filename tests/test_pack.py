@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ugit import base, data
+
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        self._git_dir = data.change_git_dir('.')
+        self._git_dir.__enter__()
+        base.init()
+
+    def tearDown(self):
+        self._git_dir.__exit__(None, None, None)
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def test_repack_by_another_process_is_picked_up(self):
+        packed = data.hash_object(b'packed')
+        data.pack_objects()
+        self.assertEqual(data.get_object(packed), b'packed')
+
+        # Packs the new object and removes its loose copy behind our back
+        loose = data.hash_object(b'loose')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        subprocess.run([sys.executable, '-c', 'from ugit.cli import main; main()', 'repack'],
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        self.assertFalse(os.path.exists(f'{data.OBJECTS_DIR}/{loose}'))
+
+        self.assertEqual(data.get_object(loose), b'loose')
+        self.assertTrue(data.object_exists(loose))
+        self.assertEqual(data.get_object(packed), b'packed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import time
+import unittest
+
+from ugit import base, data
+
+
+class StatCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        self._git_dir = data.change_git_dir('.')
+        self._git_dir.__enter__()
+        base.init()
+
+    def tearDown(self):
+        self._git_dir.__exit__(None, None, None)
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def _write(self, filename, content, mtime_ns):
+        with open(filename, 'w') as f:
+            f.write(content)
+        os.utime(filename, ns=(mtime_ns, mtime_ns))
+
+    def test_racily_clean_file_is_rehashed(self):
+        # An mtime at or after the cache was written can't tell a later
+        # same-size rewrite apart, so the entry must not be trusted
+        mtime_ns = time.time_ns() + 60 * 10**9
+        self._write('f', 'aaaa', mtime_ns)
+        base.add(['f'])
+        self._write('f', 'bbbb', mtime_ns)
+
+        self.assertEqual(base.get_working_tree()['f'],
+                         data.hash_object(b'bbbb', write=False))
+
+    def test_clean_file_uses_cache(self):
+        mtime_ns = time.time_ns() - 60 * 10**9
+        self._write('f', 'aaaa', mtime_ns)
+        base.add(['f'])
+        with data.get_stat_cache() as cache:
+            self.assertEqual(cache['f'][3], data.hash_object(b'aaaa', write=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
 import os
-import itertools
-import operator
+import functools
+import re
+import stat
 import string
 
 from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from . import data, diff
 
+_HEX_DIGITS = frozenset(string.hexdigits)
+_IGNORE_RE = re.compile(r'(?:^|[/\\])(?:\.ugit|\.git|\.venv|__pycache__)(?:[/\\]|$)')
+
 def init():
     """
     Initialize a new repository.
@@ -31,6 +36,9 @@ def write_tree():
                 current = current.setdefault(dirname, {})
             current[filename] = oid
     
+    # Trees are collected and written in one batch at the end, so
+    # identical subtrees and trees that already exist are stored once
+    pending = {}
     def write_tree_recursive(tree_dict):
         entries = []
         for name, value in tree_dict.items ():
@@ -42,69 +50,98 @@ def write_tree():
                 oid = value
             entries.append((name, oid, type_))
     
-        tree = ''.join(f'{type_} {oid} {name}\n' 
-                        for name, oid, type_ 
-                        in sorted(entries))
-        return data.hash_object(tree.encode(), 'tree')
+        entries.sort()
+        tree = b''.join([b'%s %s %s\n' % (type_.encode(), oid.encode(), name.encode())
+                         for name, oid, type_ in entries])
+        return data.hash_object(tree, 'tree', defer=pending)
     
-    return write_tree_recursive(index_as_tree)
+    oid = write_tree_recursive(index_as_tree)
+    with data.odb_transaction():
+        data.write_objects(pending)
+    return oid
 
+@functools.lru_cache(maxsize=4096)
 def _iter_tree_entries(oid):
     """
-    Iterate over entries in a tree object.
-    Yields tuples (type, oid, name) for each entry in the tree. 
+    Parse the entries of a tree object.
+    Returns a tuple of (type, oid, name) tuples, one per entry in the tree.
+    Trees are immutable, so results are memoized by object ID.
     """
     if not oid:
-        return
+        return ()
     tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(' ', 2)
-        yield type_, oid, name
+    
+    # Scan the raw bytes once instead of decoding, splitting into lines
+    # and then splitting every line again
+    entries = []
+    start = 0
+    while start < len(tree):
+        end = tree.find(b'\n', start)
+        if end == -1:
+            end = len(tree)
+        sp1 = tree.find(b' ', start, end)
+        sp2 = tree.find(b' ', sp1 + 1, end)
+        entries.append((tree[start:sp1].decode(),
+                        tree[sp1 + 1:sp2].decode(),
+                        tree[sp2 + 1:end].decode()))
+        start = end + 1
+    return tuple(entries)
 
 def get_tree (oid, base_path=''):
     """
     Build a dictionary of paths to object IDs from a tree object.
-    Recursively expands subtrees to include all files and directories.
+    Expands subtrees to include all files and directories.
     """
+    # Fill a single dictionary, keeping a stack of partly-read trees so
+    # subtrees are still expanded in place, in tree order
     result = {}
-    for type_, oid, name in _iter_tree_entries(oid):
-        assert '/' not in name
-        assert name not in ('..', '.')
-        path = base_path + name
-        if type_ == 'blob':
-            result[path] = oid
-        elif type_ == 'tree':
-            result.update(get_tree(oid, f'{path}/'))
+    stack = [(base_path, iter(_iter_tree_entries(oid)))]
+    while stack:
+        base_path, entries = stack[-1]
+        for type_, oid, name in entries:
+            assert '/' not in name
+            assert name not in ('..', '.')
+            path = base_path + name
+            if type_ == 'blob':
+                result[path] = oid
+            elif type_ == 'tree':
+                stack.append((f'{path}/', iter(_iter_tree_entries(oid))))
+                break
+            else:
+                assert False, f'Unknown tree entry type: {type_}'
         else:
-            assert False, f'Unknown tree entry type: {type_}'
+            stack.pop()
     return result
 
-def _empty_current_directory():
-    """
-    Clear the current working directory.
-    Removes all files and directories except ignored paths (.ugit, .git, .venv).
-    """
-    for root, dirnames, filenames in os.walk('.', topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f'{root}/{dirname}')
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # Deletion might fail if the directory contains ignored files,
-                # so it's OK
-                pass
+def iter_tree(oid, base_path=''):
+    """
+    Iterate over the files in a tree object.
+    Yields (path, oid) tuples without building a dictionary. Entries come
+    out in tree order, so the streams of different trees can be merged.
+    """
+    # Same stack of partly-read trees as get_tree, rather than a chain of
+    # nested generators
+    stack = [(base_path, iter(_iter_tree_entries(oid)))]
+    while stack:
+        base_path, entries = stack[-1]
+        for type_, oid, name in entries:
+            assert '/' not in name
+            assert name not in ('..', '.')
+            path = base_path + name
+            if type_ == 'blob':
+                yield path, oid
+            elif type_ == 'tree':
+                stack.append((f'{path}/', iter(_iter_tree_entries(oid))))
+                break
+            else:
+                assert False, f'Unknown tree entry type: {type_}'
+        else:
+            stack.pop()
 
 def read_tree(tree_oid, update_working=False):
     """
     Restore the working directory from a tree object.
-    Clears the current directory and writes files from the tree object.
+    Updates the index and, if requested, the working directory to match it.
     """
     with data.get_index() as index:
         index.clear()
@@ -125,9 +162,9 @@ def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
     with data.get_index() as index:
         index.clear()
         index.update(diff.merge_trees(
-            get_tree(t_base),
-            get_tree(t_HEAD),
-            get_tree(t_other)
+            iter_tree(t_base),
+            iter_tree(t_HEAD),
+            iter_tree(t_other)
         ))
         if update_working:
             _checkout_index(index)
@@ -138,35 +175,42 @@ def commit(message):
     References the current tree, optionally includes the parent commit,
     and stores the commit with the given message. Updates HEAD.
     """
-    commit = f'tree {write_tree()}\n'
+    # The trees and the commit are made durable before any ref moves
+    with data.odb_transaction():
+        lines = [f'tree {write_tree()}']
+        
+        HEAD = data.get_ref('HEAD').value
+        if HEAD:
+            lines.append(f'parent {HEAD}')
+        MERGE_HEAD = data.get_ref('MERGE_HEAD').value
+        if MERGE_HEAD:
+            lines.append(f'parent {MERGE_HEAD}')
+        
+        lines += ['', '', message, '']
+        commit = '\n'.join(lines)
+        
+        oid = data.hash_object(commit.encode(), 'commit')
     
-    HEAD = data.get_ref('HEAD').value
-    if HEAD:
-        commit += f'parent {HEAD}\n'
-    MERGE_HEAD = data.get_ref('MERGE_HEAD').value
     if MERGE_HEAD:
-        commit += f'parent {MERGE_HEAD}\n)'
         data.delete_ref('MERGE_HEAD', deref=False)
-    
-    commit += '\n'
-    commit += f'\n{message}\n'
-
-    oid = data.hash_object(commit.encode(), 'commit')
     data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
     return oid
 
 Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
+@functools.lru_cache(maxsize=4096)
 def get_commit(oid):
     """
     Parse a commit object.
-    Returns a Commit namedtuple with fields: tree, parent, message.
+    Returns a Commit namedtuple with fields: tree, parents, message.
+    Commits are immutable, so results are memoized by object ID.
     """
+    tree = None
     parents = []
     
     commit = data.get_object(oid, 'commit').decode()
-    lines = iter(commit.splitlines())
-    for line in itertools.takewhile(operator.truth, lines):
-        key, value = line.split(' ', 1)
+    header, _, message = commit.partition('\n\n')
+    for line in header.split('\n'):
+        key, _, value = line.partition(' ')
         if key == 'tree':
             tree = value
         elif key == 'parent':
@@ -174,8 +218,8 @@ def get_commit(oid):
         else:
             assert False, f'Unknown commit field: {key}'
     
-    message = '\n'.join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+    message = message.removesuffix('\n')
+    return Commit(tree=tree, parents=tuple(parents), message=message)
 
 def checkout(name):
     """
@@ -207,6 +251,10 @@ def get_oid(name):
     """
     if name == '@': name = 'HEAD'
     
+    # A full SHA-1 is unambiguous, so don't touch the disk for it
+    if len(name) == 40 and _HEX_DIGITS.issuperset(name):
+        return name
+    
     refs_to_try = [f'{name}',
                 f'refs/{name}',
                 f'refs/heads/{name}',
@@ -216,16 +264,13 @@ def get_oid(name):
         if data.get_ref(ref, deref=False).value:
             return data.get_ref(ref).value
     
-    is_hex = all(c in string.hexdigits for c in name)
-    if len(name) == 40 and is_hex:
-        return name
-    
     assert False, f'Unknown name: {name}'
 
 def iter_commits_and_parents(oids):
     """
     Iterate over commits and their parents.
-    Given a list of commit object IDs, yields each commit ID and its ancestors.
+    Given a list of commit object IDs, yields each commit ID and its ancestors
+    in breadth-first order, following every parent of merge commits.
     """
     # N.B. Must yield the oid before acccessing it (to allow caller to fetch it if needed)
     oids = deque(oids)
@@ -237,9 +282,9 @@ def iter_commits_and_parents(oids):
             continue
         visited.add(oid)
         yield oid
-        commit = get_commit(oid)
-        oids.extendleft(commit.parents[:1])
-        oids.extend(commit.parents[:1])
+        for parent in get_commit(oid).parents:
+            if parent not in visited:
+                oids.append(parent)
 
 def iter_objects_in_commits(oids):
     """
@@ -249,15 +294,23 @@ def iter_objects_in_commits(oids):
     """
     visited = set()
     def iter_objects_in_tree(oid):
-        visited.add(oid)
-        yield oid
-        for type_, oid, _ in _iter_tree_entries(oid):
-            if oid not in visited:
+        # Explicit stack instead of recursion, so deep trees don't pay for
+        # a chain of nested generators
+        stack = [oid]
+        while stack:
+            oid = stack.pop()
+            if oid in visited:
+                continue
+            visited.add(oid)
+            yield oid
+            for type_, child_oid, _ in _iter_tree_entries(oid):
+                if child_oid in visited:
+                    continue
                 if type_ == 'tree':
-                    yield from iter_objects_in_tree(oid)
+                    stack.append(child_oid)
                 else:
-                    visited.add(oid)
-                    yield oid
+                    visited.add(child_oid)
+                    yield child_oid
     
     for oid in iter_commits_and_parents(oids):
         yield oid
@@ -311,14 +364,69 @@ def get_working_tree():
     """
     Get the working tree as a dictionary of paths to object IDs.
     """
+    return _hash_files(_list_files('.'))
+
+def _list_files(dirname):
+    """
+    List all files under a directory, skipping ignored paths.
+    Returns a dictionary of paths to their stat results. Paths are relative
+    to the current directory and use '/' as separator.
+    """
+    prefix = os.path.relpath(dirname).replace(os.sep, '/')
+    prefix = '' if prefix == '.' else f'{prefix}/'
+    
+    files = {}
+    stack = [prefix]
+    while stack:
+        prefix = stack.pop()
+        with os.scandir(prefix or '.') as entries:
+            for entry in entries:
+                path = f'{prefix}{entry.name}'
+                if is_ignored(path):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(f'{path}/')
+                    continue
+                # One stat both classifies the entry and feeds the stat cache
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    # Dangling symlink
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files[path] = st
+    return files
+
+def _hash_files(files, write=True):
+    """
+    Hash a batch of files as blob objects.
+    `files` maps each path to its stat result, as returned by `_list_files`.
+    Files whose mtime, size and inode match the stat cache reuse the
+    cached object ID instead of being read again; the rest are hashed
+    in parallel, since file reads and SHA-1 both release the GIL.
+    With `write` False nothing is stored: not the objects, and not their
+    stat cache entries, since a cache hit promises the object exists.
+    Returns a dictionary of paths to object IDs.
+    """
     result = {}
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}').replace(os.sep, '/')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
+    with data.get_stat_cache() as cache:
+        stale = []
+        for path, st in files.items():
+            key = [st.st_mtime_ns, st.st_size, st.st_ino]
+            cached = cache.get(path)
+            if cached and cached[:3] == key:
+                result[path] = cached[3]
+            else:
+                stale.append((path, key))
+        
+        # Identical files share an object ID; only write each one once
+        hash_file = functools.partial(data.hash_file, written=set(), write=write)
+        with ThreadPoolExecutor() as pool:
+            oids = pool.map(hash_file, [path for path, _ in stale])
+            for (path, key), oid in zip(stale, oids):
+                if write:
+                    cache[path] = key + [oid]
+                result[path] = oid
     return result
 
 def merge(other):
@@ -348,11 +456,34 @@ def merge(other):
 def _checkout_index(index):
     """
     Checkout the index into the working directory.
+    Only touches files that differ: files missing from the index are
+    removed, and files whose content differs are written.
 
     :param index: The index to checkout.
     """
-    _empty_current_directory()
+    files = _list_files('.')
+    removed = files.keys() - index.keys()
+    # Only files the index keeps need hashing, and only to compare them;
+    # files about to be replaced shouldn't be stored as objects on the way out
+    current = _hash_files({path: st for path, st in files.items() if path in index},
+                          write=False)
+    
+    for path in removed:
+        os.remove(path)
+    for dirname in {os.path.dirname(path) for path in removed}:
+        if not dirname:
+            continue
+        try:
+            # Also prunes parent directories left empty
+            os.removedirs(dirname)
+        except OSError:
+            # Deletion might fail if the directory still contains files,
+            # so it's OK
+            pass
+    
     for path, oid in index.items():
+        if current.get(path) == oid:
+            continue
         os.makedirs (os.path.dirname (f'./{path}'), exist_ok=True)
         with open (path, 'wb') as f:
             f.write(data.get_object(oid,'blob'))
@@ -365,10 +496,36 @@ def get_merge_base(oid1, oid2):
     :param oid2: The second commit object ID.
     :return: The merge base commit object ID.
     """
-    parents1 = set(iter_commits_and_parents({oid1}))
+    ancestors1 = set(iter_commits_and_parents({oid1}))
+    
+    # Walk back from oid2, stopping at the first commits that oid1 can
+    # also reach; those are the candidate common ancestors
+    candidates = []
+    queue, visited = deque([oid2]), {oid2}
+    while queue:
+        oid = queue.popleft()
+        if oid in ancestors1:
+            candidates.append(oid)
+            continue
+        for parent in get_commit(oid).parents:
+            if parent not in visited:
+                visited.add(parent)
+                queue.append(parent)
     
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    if len(candidates) == 1:
+        return candidates[0]
+    
+    # A candidate reachable from another candidate is not the best one. At
+    # least one candidate always survives, so the walk can stop as soon as
+    # all but one of them have been reached
+    remaining = set(candidates)
+    parents = [parent for oid in candidates for parent in get_commit(oid).parents]
+    for oid in iter_commits_and_parents(parents):
+        remaining.discard(oid)
+        if len(remaining) == 1:
+            break
+    for oid in candidates:
+        if oid in remaining:
             return oid
 
 def is_ascestor_of(commit, maybe_ascestor):
@@ -387,35 +544,22 @@ def add(filenames):
 
     :param filenames: A list of filenames to add.
     """
-    def add_file(filename):
-        filename = os.path.relpath(filename).replace(os.sep, '/')
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
-
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.join(root, filename)
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+    files = {}
+    for name in filenames:
+        if os.path.isfile(name):
+            files[os.path.relpath(name).replace(os.sep, '/')] = os.stat(name)
+        elif os.path.isdir(name):
+            files.update(_list_files(name))
 
     with data.get_index() as index:
-        for name in filenames:
-            if os.path.isfile(name):
-                add_file(name)
-            elif os.path.isdir(name):
-                add_directory(name) 
+        index.update(_hash_files(files))
 
 def is_ignored(path):
     """
     Determine if a path should be ignored.
-    Returns True if the path is inside `.ugit`, `.git`, or `.venv`.
+    Returns True if the path is inside `.ugit`, `.git`, `.venv` or `__pycache__`.
     """
-    ignored_dirs = {'.ugit', '.git', '.venv', '__pycache__'}
-    parts = os.path.normpath(path).split(os.sep)
-    return any(part in ignored_dirs for part in parts)
+    return _IGNORE_RE.search(path) is not None
 
 def get_index_tree():
     """
@@ -1,106 +1,199 @@
 import os
 import argparse
+import functools
 import sys
-import textwrap
-import subprocess
-
-from . import data, base, diff, remote
 
 def main ():
+    args = parse_args()
+    
+    from . import data
     with data.change_git_dir('.'):
-        args = parse_args()
-        args.func(args)
+        _DISPATCH[args.command](args)
+
+def parse_args (argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    return _build_parser(_sniff_subcommand(argv)).parse_args(argv)
+
+@functools.lru_cache(maxsize=None)
+def _build_parser(command):
+    """
+    Build the argument parser for a subcommand.
+    Parsers hold no per-invocation state, so each one is built once per
+    process and reused.
 
-def parse_args ():
+    :param command: The subcommand to build, or None to build all of them.
+    """
     parser = argparse.ArgumentParser(description='ugit - a simple git implementation')
     
     commands = parser.add_subparsers(title='Commands', dest='command')
     commands.required = True
     
-    oid = base.get_oid
-    
-    init_parser = commands.add_parser('init', help='Initialize a new repository')
-    init_parser.set_defaults(func=init)
-    
-    hash_objet_parser = commands.add_parser('hash-object', help='Compute object ID and optionally create a blob from a file')
-    hash_objet_parser.set_defaults(func=hash_object)
-    hash_objet_parser.add_argument('file', help='The file to hash')
-    
-    cat_file_parser = commands.add_parser('cat-file', help='Provide content of repository objects')
-    cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument('object', type=oid, help='The object ID to display')
-    
-    write_tree_parser = commands.add_parser('write-tree', help='Write the current directory as a tree object')
-    write_tree_parser.set_defaults(func=write_tree)
-    
-    read_tree_parser = commands.add_parser('read-tree', help='Read a tree object into the working directory')
-    read_tree_parser.set_defaults(func=read_tree)
-    read_tree_parser.add_argument('tree', type=oid, help='The tree object ID to read')
-    
-    commit_parser = commands.add_parser('commit', help='Create a new commit object')
-    commit_parser.set_defaults(func=commit)
-    commit_parser.add_argument('-m', '--message', required=True, help='The commit message')
-    
-    log_parser = commands.add_parser('log', help='Display commit logs')
-    log_parser.set_defaults(func=log)
-    log_parser.add_argument('oid', default='@', type=oid, nargs='?', help='The commit object ID to start from')
-    
-    checkout_parser = commands.add_parser('checkout', help='Checkout a commit into the working directory')
-    checkout_parser.set_defaults(func=checkout)
-    checkout_parser.add_argument('commit', help='The commit ID or branch name to checkout')
-    
-    tag_parser = commands.add_parser('tag', help='Create a new tag object')
-    tag_parser.set_defaults(func=tag)
-    tag_parser.add_argument('name', help='The name of the tag')
-    tag_parser.add_argument('oid', default='@', type=oid, nargs='?', help='The object ID the tag points to')
-    
-    k_parser = commands.add_parser('k', help='Visualize the commit history.')
-    k_parser.set_defaults(func=k)
-    
-    branch_parser = commands.add_parser('branch', help='List, create')
-    branch_parser.set_defaults(func=branch)
-    branch_parser.add_argument('name', nargs='?', help='The name of the branch to create.')
-    branch_parser.add_argument('start_point', default='@', type=oid, nargs='?', help='The commit to start the new branch from.')
-    
-    status_parser = commands.add_parser('status', help='Show the working-tree status.')
-    status_parser.set_defaults(func=status)
-    
-    reset_parser = commands.add_parser('reset', help='Reset current HEAD to the specified state.')
-    reset_parser.set_defaults(func=reset)
-    reset_parser.add_argument('commit', type=oid, help='The commit to reset to.')
-    
-    show_parser = commands.add_parser('show', help='Show various types of objects.')
-    show_parser.set_defaults(func=show)
-    show_parser.add_argument('oid', default='@', type=oid, nargs='?', help='The object to show.')
-    
-    diff_parser = commands.add_parser('diff', help='Show changes between commits, commit and working tree, etc.')
-    diff_parser.set_defaults(func=_diff)
-    diff_parser.add_argument('--cached', action='store_true', help='Show changes staged for commit.')
-    diff_parser.add_argument('commit', nargs='?', help='The commit to compare against.')
-    
-    merge_parser = commands.add_parser('merge', help='Join two or more development histories together.')
-    merge_parser.set_defaults(func=merge)
-    merge_parser.add_argument('commit', type=oid, help='The commit to merge into the current branch.')
-    
-    merge_base_parser = commands.add_parser('merge-base', help='Find first common ancestor between two commits.')
-    merge_base_parser.set_defaults(func=merge_base)
-    merge_base_parser.add_argument('commit1', type=oid, help='The first commit.')
-    merge_base_parser.add_argument('commit2', type=oid, help='The second commit.')
-    
-    fetch_parser = commands.add_parser('fetch', help='Download objects and refs from another repository.')
-    fetch_parser.set_defaults(func=fetch)
-    fetch_parser.add_argument('remote', help='The remote repository to fetch from.')
-    
-    push_parser = commands.add_parser('push', help='Update remote refs along with associated objects.')
-    push_parser.set_defaults(func=push)
-    push_parser.add_argument('remote', help='The remote repository to push to.')
-    push_parser.add_argument('branch', help='The branch to push.')
-    
-    add_parser = commands.add_parser('add', help='Add file contents to the index.')
-    add_parser.set_defaults(func=add)
-    add_parser.add_argument('files', nargs='+', help='The files to add.')
-    
-    return parser.parse_args()
+    # Only one subcommand ever runs, so only build that one. Without a
+    # recognisable subcommand (e.g. --help), build them all for the listing.
+    # The help strings only show up in the command listing, so skip them
+    # when building a single subcommand.
+    if command:
+        _COMMANDS[command](commands, want_help=False)
+    else:
+        for build in _COMMANDS.values():
+            build(commands, want_help=True)
+    return parser
+
+def _sniff_subcommand(argv):
+    """
+    Find the subcommand in the command-line arguments.
+    Returns the first non-option argument if it names a known command,
+    otherwise None.
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg if arg in _COMMANDS else None
+    return None
+
+def _add_parser(commands, name, want_help):
+    """
+    Add the subparser for a command, with its help string only if wanted.
+    """
+    if not want_help:
+        # Even help=None makes argparse build a listing entry for the command
+        return commands.add_parser(name)
+    return commands.add_parser(name, help=_HELP[name])
+
+# One-line descriptions shown in the command listing
+_HELP = {
+    'init': 'Initialize a new repository',
+    'hash-object': 'Compute object ID and optionally create a blob from a file',
+    'cat-file': 'Provide content of repository objects',
+    'write-tree': 'Write the current directory as a tree object',
+    'read-tree': 'Read a tree object into the working directory',
+    'commit': 'Create a new commit object',
+    'log': 'Display commit logs',
+    'checkout': 'Checkout a commit into the working directory',
+    'tag': 'Create a new tag object',
+    'k': 'Visualize the commit history.',
+    'branch': 'List, create',
+    'status': 'Show the working-tree status.',
+    'reset': 'Reset current HEAD to the specified state.',
+    'show': 'Show various types of objects.',
+    'diff': 'Show changes between commits, commit and working tree, etc.',
+    'merge': 'Join two or more development histories together.',
+    'merge-base': 'Find first common ancestor between two commits.',
+    'fetch': 'Download objects and refs from another repository.',
+    'push': 'Update remote refs along with associated objects.',
+    'add': 'Add file contents to the index.',
+    'repack': 'Pack all objects into a single packfile.',
+}
+
+# Subparser builders, one per command
+
+def _build_init(commands, want_help):
+    _add_parser(commands, 'init', want_help)
+
+def _build_hash_object(commands, want_help):
+    parser = _add_parser(commands, 'hash-object', want_help)
+    parser.add_argument('file', help='The file to hash')
+
+def _build_cat_file(commands, want_help):
+    parser = _add_parser(commands, 'cat-file', want_help)
+    parser.add_argument('object', help='The object ID to display')
+
+def _build_write_tree(commands, want_help):
+    _add_parser(commands, 'write-tree', want_help)
+
+def _build_read_tree(commands, want_help):
+    parser = _add_parser(commands, 'read-tree', want_help)
+    parser.add_argument('tree', help='The tree object ID to read')
+
+def _build_commit(commands, want_help):
+    parser = _add_parser(commands, 'commit', want_help)
+    parser.add_argument('-m', '--message', required=True, help='The commit message')
+
+def _build_log(commands, want_help):
+    parser = _add_parser(commands, 'log', want_help)
+    parser.add_argument('oid', default='@', nargs='?', help='The commit object ID to start from')
+
+def _build_checkout(commands, want_help):
+    parser = _add_parser(commands, 'checkout', want_help)
+    parser.add_argument('commit', help='The commit ID or branch name to checkout')
+
+def _build_tag(commands, want_help):
+    parser = _add_parser(commands, 'tag', want_help)
+    parser.add_argument('name', help='The name of the tag')
+    parser.add_argument('oid', default='@', nargs='?', help='The object ID the tag points to')
+
+def _build_k(commands, want_help):
+    _add_parser(commands, 'k', want_help)
+
+def _build_branch(commands, want_help):
+    parser = _add_parser(commands, 'branch', want_help)
+    parser.add_argument('name', nargs='?', help='The name of the branch to create.')
+    parser.add_argument('start_point', default='@', nargs='?', help='The commit to start the new branch from.')
+
+def _build_status(commands, want_help):
+    _add_parser(commands, 'status', want_help)
+
+def _build_reset(commands, want_help):
+    parser = _add_parser(commands, 'reset', want_help)
+    parser.add_argument('commit', help='The commit to reset to.')
+
+def _build_show(commands, want_help):
+    parser = _add_parser(commands, 'show', want_help)
+    parser.add_argument('oid', default='@', nargs='?', help='The object to show.')
+
+def _build_diff(commands, want_help):
+    parser = _add_parser(commands, 'diff', want_help)
+    parser.add_argument('--cached', action='store_true', help='Show changes staged for commit.')
+    parser.add_argument('commit', nargs='?', help='The commit to compare against.')
+
+def _build_merge(commands, want_help):
+    parser = _add_parser(commands, 'merge', want_help)
+    parser.add_argument('commit', help='The commit to merge into the current branch.')
+
+def _build_merge_base(commands, want_help):
+    parser = _add_parser(commands, 'merge-base', want_help)
+    parser.add_argument('commit1', help='The first commit.')
+    parser.add_argument('commit2', help='The second commit.')
+
+def _build_fetch(commands, want_help):
+    parser = _add_parser(commands, 'fetch', want_help)
+    parser.add_argument('remote', help='The remote repository to fetch from.')
+
+def _build_push(commands, want_help):
+    parser = _add_parser(commands, 'push', want_help)
+    parser.add_argument('remote', help='The remote repository to push to.')
+    parser.add_argument('branch', help='The branch to push.')
+
+def _build_add(commands, want_help):
+    parser = _add_parser(commands, 'add', want_help)
+    parser.add_argument('files', nargs='+', help='The files to add.')
+
+def _build_repack(commands, want_help):
+    _add_parser(commands, 'repack', want_help)
+
+_COMMANDS = {
+    'init': _build_init,
+    'hash-object': _build_hash_object,
+    'cat-file': _build_cat_file,
+    'write-tree': _build_write_tree,
+    'read-tree': _build_read_tree,
+    'commit': _build_commit,
+    'log': _build_log,
+    'checkout': _build_checkout,
+    'tag': _build_tag,
+    'k': _build_k,
+    'branch': _build_branch,
+    'status': _build_status,
+    'reset': _build_reset,
+    'show': _build_show,
+    'diff': _build_diff,
+    'merge': _build_merge,
+    'merge-base': _build_merge_base,
+    'fetch': _build_fetch,
+    'push': _build_push,
+    'add': _build_add,
+    'repack': _build_repack,
+}
 
 # Command implementations
     
@@ -110,6 +203,7 @@ def init (args):
     Creates the .ugit directory structure.
         Usage: ugit init   
     """
+    from . import base, data
     base.init()
     print (f'Initializing empty ugit repository in {os.getcwd()}/{data.GIT_DIR}')
 
@@ -119,8 +213,8 @@ def hash_object (args):
     compute its SHA-1 hash, store it in .ugit/objects/ and print the object ID)
         Usage: ugit hash-object <file>
     """
-    with open(args.file, 'rb') as f:
-        print(data.hash_object(f.read()))
+    from . import data
+    print(data.hash_file(args.file))
 
 def cat_file (args):
     """
@@ -128,8 +222,9 @@ def cat_file (args):
     read the corresponding file from .ugit/objects/ and print its content)
         Usage: ugit cat-file <object>
     """
-    sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    from . import base, data
+    oid = base.get_oid(args.object)
+    _bulk_write(data.get_object(oid, expected=None))
 
     
 def write_tree (args):
@@ -139,6 +234,7 @@ def write_tree (args):
     store them in .ugit/objects/ and print the tree object ID)
         Usage: ugit write-tree
     """    
+    from . import base
     print(base.write_tree())
 
 def read_tree (args):
@@ -148,7 +244,8 @@ def read_tree (args):
     according to the tree object)
         Usage: ugit read-tree <tree>
     """
-    base.read_tree(args.tree)
+    from . import base
+    base.read_tree(base.get_oid(args.tree))
 
 def commit (args):
     """
@@ -157,6 +254,7 @@ def commit (args):
     store it in .ugit/objects/ and print the commit object ID)
         Usage: ugit commit -m <message>
     """
+    from . import base
     print(base.commit(args.message))
 
 def log (args):
@@ -165,14 +263,29 @@ def log (args):
     traverse the commit history and print each commit's ID and message)
         Usage: ugit log [<oid>]
     """
+    from . import base, data
+    refs = _build_refs_index(data.GIT_DIR, data.refs_generation())
+
+    # Bind the per-commit lookups once, outside the loop
+    get_commit, get_refs = base.get_commit, refs.get
+    for oid in base.iter_commits_and_parents([base.get_oid(args.oid)]):
+        _print_commit(oid, get_commit(oid), get_refs(oid))
+
+@functools.lru_cache(maxsize=4)
+def _build_refs_index(git_dir, generation):
+    """
+    Map each commit object ID to the names of the refs pointing at it.
+    The arguments only key the cache; the index is rebuilt whenever
+    a ref is updated or deleted, or the git directory is changed.
+
+    :param git_dir: The git directory the refs belong to.
+    :param generation: The value of `data.refs_generation()`.
+    """
+    from . import data
     refs = {}
     for refname, ref in data.iter_refs():
         refs.setdefault(ref.value, []).append(refname)
-
-    for oid in base.iter_commits_and_parents([args.oid]):
-        commit = base.get_commit(oid)
-        
-        _print_commit(oid, commit, refs.get(oid))
+    return refs
 
 def checkout (args):
     """
@@ -180,6 +293,7 @@ def checkout (args):
     the state of the given commit ID and updates HEAD to point to that commit.
         Usage: ugit checkout <oid>
     """
+    from . import base
     base.checkout(args.commit)
 
 def tag (args):
@@ -188,40 +302,79 @@ def tag (args):
     store it in .ugit/objects/)
         Usage: ugit tag <name> <oid>
     """
-    base.created_tag(args.name, args.oid)
+    from . import base
+    base.created_tag(args.name, base.get_oid(args.oid))
 
 def k(args):
     """
     Visualize the commit history.
 
+    The graph is written to stdout and rendered to commit-graph.png.
+    With pygraphviz installed it is laid out in-process; otherwise it
+    is streamed to `dot` as it is generated, so graphviz can start
+    reading before the walk finishes.
+
     :param args: The arguments from the command line.
     """
-    dot = 'digraph commits {\n'
+    try:
+        import pygraphviz
+    except ImportError:
+        pygraphviz = None
+    if pygraphviz:
+        dot = ''.join(_iter_dot_graph())
+        print(dot)
+        pygraphviz.AGraph(string=dot).draw('commit-graph.png', format='png', prog='dot')
+        return
+
+    import contextlib
+    import shutil
+    import subprocess
+    try:
+        proc = subprocess.Popen(
+            ['dot', '-Tpng'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        proc = None
+
+    with proc or contextlib.nullcontext():
+        write = sys.stdout.write
+        for chunk in _iter_dot_graph():
+            write(chunk)
+            if proc:
+                proc.stdin.write(chunk.encode())
+        write('\n')
+        if proc:
+            proc.stdin.close()
+            with open('commit-graph.png', 'wb') as f:
+                shutil.copyfileobj(proc.stdout, f)
     
+    if not proc:
+        print('warning: graphviz `dot` not found, commit-graph.png not written',
+              file=sys.stderr)
+
+def _iter_dot_graph():
+    """
+    Yield the commit graph in DOT format, a few lines at a time.
+    """
+    from . import base, data
+    yield 'digraph commits {\n'
+
     oids = set()
     for refname, ref in data.iter_refs(deref=False):
-        dot += f'"{refname}" [shape=box];\n'
-        dot += f'"{refname}" -> "{ref.value}";\n'
+        yield f'"{refname}" [shape=box];\n"{refname}" -> "{ref.value}";\n'
         if not ref.symbolic:
             oids.add(ref.value)
-    
+
+    get_commit = base.get_commit
     for oid in base.iter_commits_and_parents(oids):
-        commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=oval style=filled label="{oid[:10]}"];\n'
-        for parent in commit.parents:
-            dot += f'"{oid}" -> "{parent}"\n'
-    
-    dot += '}\n'
-    print(dot)
-    
-    with subprocess.Popen(
-        ['dot', '-Tpng'], 
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE
-    ) as proc:
-        out, _ = proc.communicate(dot.encode())
-        with open('commit-graph.png', 'wb') as f:
-            f.write(out)
+        parts = [f'"{oid}" [shape=oval style=filled label="{oid[:10]}"];\n']
+        for parent in get_commit(oid).parents:
+            parts.append(f'"{oid}" -> "{parent}"\n')
+        yield ''.join(parts)
+
+    yield '}\n'
 
 def branch(args):
     """
@@ -229,14 +382,16 @@ def branch(args):
 
     :param args: The arguments from the command line.
     """
+    from . import base
     if not args.name:
         current = base.get_branch_name()
         for branch in base.iter_branch_names():
             prefix = '*' if branch == current else ' '
             print(f'{prefix} {branch}')
     else:
-        base.create_branch(args.name, args.start_point) 
-        print(f'Branch {args.name} created at {args.start_point[:10]}')
+        start_point = base.get_oid(args.start_point)
+        base.create_branch(args.name, start_point) 
+        print(f'Branch {args.name} created at {start_point[:10]}')
 
 def status(args):
     """
@@ -244,6 +399,7 @@ def status(args):
 
     :param args: The arguments from the command line.
     """
+    from . import base, data, diff
     HEAD = base.get_oid('@')
     branch = base.get_branch_name()
     if branch:
@@ -269,8 +425,10 @@ def reset(args):
 
     :param args: The arguments from the command line.
     """
-    base.reset(args.commit)
-    print(f'HEAD reset to {args.commit[:10]}')
+    from . import base
+    oid = base.get_oid(args.commit)
+    base.reset(oid)
+    print(f'HEAD reset to {oid[:10]}')
 
 def _print_commit(oid, commit, refs=None):
     """
@@ -280,10 +438,28 @@ def _print_commit(oid, commit, refs=None):
     :param commit: The commit object.
     :param refs: A list of refs pointing to the commit.
     """
+    import textwrap
     refs_str = f' ({", ".join(refs)})' if refs else ''
-    print(f'commit {oid}{refs_str}\n')
-    print(textwrap.indent(commit.message, '    '))
-    print('')
+    # One write per commit instead of a print per line
+    sys.stdout.write(
+        f'commit {oid}{refs_str}\n\n'
+        f'{textwrap.indent(commit.message, "    ")}\n\n'
+    )
+
+def _bulk_write(payload, chunk_size=1 << 20):
+    """
+    Write bytes straight to the stdout file descriptor, bypassing
+    Python's buffered writer. Anything already printed is flushed first
+    so the output stays in order.
+
+    :param payload: The bytes to write.
+    :param chunk_size: The most bytes handed to a single write call.
+    """
+    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    view = memoryview(payload)
+    while view:
+        view = view[os.write(fd, view[:chunk_size]):]
 
 def show(args):
     """
@@ -291,17 +467,18 @@ def show(args):
 
     :param args: The arguments from the command line.
     """
-    if not args.oid:
+    from . import base, diff
+    oid = base.get_oid(args.oid)
+    if not oid:
         return
-    commit = base.get_commit(args.oid)
+    commit = base.get_commit(oid)
     
     parent_tree = None
     if commit.parents:
         parent_tree = base.get_commit(commit.parents[0]).tree
-    _print_commit(args.oid, commit)
-    result = diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree))
-    sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    _print_commit(oid, commit)
+    for chunk in diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree)):
+        _bulk_write(chunk)
 
 def _diff(args):
     """
@@ -309,6 +486,7 @@ def _diff(args):
 
     :param args: The arguments from the command line.
     """
+    from . import base, diff
     if args.cached:
         tree_to = base.get_index_tree()
         if args.commit:
@@ -329,9 +507,8 @@ def _diff(args):
             # diff working tree against index
             tree_from = base.get_index_tree()
 
-    result = diff.diff_trees(tree_from, tree_to)
-    sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_trees(tree_from, tree_to):
+        _bulk_write(chunk)
 
 def merge(args):
     """
@@ -339,7 +516,8 @@ def merge(args):
 
     :param args: The arguments from the command line.
     """
-    base.merge(args.commit)
+    from . import base
+    base.merge(base.get_oid(args.commit))
 
 def merge_base(args):
     """
@@ -347,7 +525,8 @@ def merge_base(args):
 
     :param args: The arguments from the command line.
     """
-    print(base.get_merge_base(args.commit1, args.commit2))
+    from . import base
+    print(base.get_merge_base(base.get_oid(args.commit1), base.get_oid(args.commit2)))
 
 def fetch(args):
     """
@@ -355,6 +534,7 @@ def fetch(args):
 
     :param args: The arguments from the command line.
     """
+    from . import remote
     remote.fetch(args.remote)
 
 def push(args):
@@ -363,6 +543,7 @@ def push(args):
 
     :param args: The arguments from the command line.
     """
+    from . import remote
     remote.push(args.remote, f'refs/heads/{args.branch}')
 
 def add(args):
@@ -371,4 +552,39 @@ def add(args):
 
     :param args: The arguments from the command line.
     """
-    base.add(args.files)
\ No newline at end of file
+    from . import base
+    base.add(args.files)
+
+def repack(args):
+    """
+    Pack all objects into a single packfile.
+
+    :param args: The arguments from the command line.
+    """
+    from . import data
+    print(f'Packed {data.pack_objects()} objects')
+
+# Command name to implementation, used by main() to run the parsed command
+_DISPATCH = {
+    'init': init,
+    'hash-object': hash_object,
+    'cat-file': cat_file,
+    'write-tree': write_tree,
+    'read-tree': read_tree,
+    'commit': commit,
+    'log': log,
+    'checkout': checkout,
+    'tag': tag,
+    'k': k,
+    'branch': branch,
+    'status': status,
+    'reset': reset,
+    'show': show,
+    'diff': _diff,
+    'merge': merge,
+    'merge-base': merge_base,
+    'fetch': fetch,
+    'push': push,
+    'add': add,
+    'repack': repack,
+}
@@ -1,12 +1,46 @@
 import os
 import hashlib
+import mmap
 import shutil
 import json
+import threading
 
-from collections import namedtuple
+from array import array
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 
 GIT_DIR = None
+# f'{GIT_DIR}/objects', kept in step with GIT_DIR by change_git_dir
+OBJECTS_DIR = None
+
+# Files at least this big are memory-mapped instead of read when hashed
+MMAP_THRESHOLD = 64 * 1024
+
+# Loaded packfiles as (file signature, pack), keyed by git directory
+_packs = {}
+# Git directories whose pack has been checked against the file on disk
+# since the git directory last changed
+_packs_checked = set()
+
+# Recently read objects as (type, content), most recently used last.
+# Objects never change, so entries only ever need evicting for space.
+OBJECT_CACHE_BYTES = 64 << 20
+OBJECT_CACHE_MAX_OBJECT = 1 << 20
+_object_cache = OrderedDict()
+_object_cache_size = 0
+_object_cache_lock = threading.Lock()
+
+# Objects written in the current odb_transaction(), if any, as a dict
+# of their final paths to the temporary files they wait in until it ends
+_odb_pending = None
+
+# Resolved refs, as returned by _get_ref_internal, keyed by
+# (git directory, ref, deref). Dropped whenever any ref changes.
+_ref_cache = {}
+
+# Bumped whenever a ref is written or deleted through this module,
+# and whenever the git directory is changed
+_ref_generation = 0
 
 @contextmanager
 def change_git_dir(new_dir):
@@ -15,11 +49,18 @@ def change_git_dir(new_dir):
 
     :param new_dir: The new directory to set as the git directory.
     """
-    global GIT_DIR
-    old_dir = GIT_DIR
+    global GIT_DIR, OBJECTS_DIR
+    old_dir, old_objects_dir = GIT_DIR, OBJECTS_DIR
     GIT_DIR = f'{new_dir}/.ugit'
+    OBJECTS_DIR = f'{GIT_DIR}/objects'
+    # The refs and packs may belong to another repository, or have been
+    # changed by another process since we last looked
+    _refs_changed()
+    _packs_checked.clear()
     yield
-    GIT_DIR = old_dir
+    GIT_DIR, OBJECTS_DIR = old_dir, old_objects_dir
+    _refs_changed()
+    _packs_checked.clear()
 
 def init ():
     """
@@ -27,7 +68,7 @@ def init ():
     Creates `.ugit` and `.ugit/objects` directories if they do not exist.
     """
     os.makedirs(GIT_DIR, exist_ok=True)
-    os.makedirs(f'{GIT_DIR}/objects', exist_ok=True)
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
 
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 def update_ref(ref, value, deref=True):
@@ -47,6 +88,7 @@ def update_ref(ref, value, deref=True):
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, 'w') as f:
         f.write(value)
+    _refs_changed()
 
 def get_ref(ref, deref=True):
     """
@@ -60,67 +102,400 @@ def _get_ref_internal(ref, deref):
     Internal helper to retrieve reference value.
     Handles symbolic references and returns the resolved reference name and value.
     """ 
-    ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path, 'r') as f:
-            value = f.read().strip()
+    key = (GIT_DIR, ref, deref)
+    if key in _ref_cache:
+        return _ref_cache[key]
+    
+    # A ref is a few dozen bytes, so one read gets all of it. Work on the
+    # raw bytes and decode only the final value.
+    try:
+        fd = os.open(f'{GIT_DIR}/{ref}', os.O_RDONLY)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        buf = None
+    else:
+        try:
+            buf = os.read(fd, 4096).strip()
+        except IsADirectoryError:
+            buf = None
+        finally:
+            os.close(fd)
     
-    symbolic = bool(value) and value.startswith('ref: ')
+    symbolic = bool(buf) and buf.startswith(b'ref: ')
     if symbolic:
-        value = value.split(' ', 1)[1].strip()
-        if deref:
-            return _get_ref_internal(value, deref=True)
+        buf = buf[5:].strip()
+    value = None if buf is None else buf.decode()
     
-    return ref, RefValue(symbolic=symbolic, value=value)
+    if symbolic and deref:
+        result = _get_ref_internal(value, deref=True)
+    else:
+        result = ref, RefValue(symbolic=symbolic, value=value)
+    _ref_cache[key] = result
+    return result
 
-def hash_object (data, type='blob'):
+def hash_object (data, type='blob', defer=None, written=None, write=True):
     """
     Store an object in `.ugit/objects`.
     Prepends the type (blob/tree/commit) to the data,
     computes its SHA-1 hash, saves it under `.ugit/objects/<oid>`,
     and returns the object ID. 
+    If `defer` is a dictionary, the object is added to it instead of
+    being written, so a batch can be stored later with `write_objects`.
+    If `written` is a set, objects whose ID is already in it are not
+    written again, and newly written IDs are added to it.
+    Objects that are already stored are never rewritten.
+    If `write` is False, only the object ID is computed.
     """
-    obj = type.encode() + b'\x00' + data
-    oid = hashlib.sha1(obj).hexdigest()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    # Hash and write the header and data separately rather than
+    # concatenating them, which would copy the whole content.
+    # Object IDs are content addresses, not a security boundary, so let
+    # OpenSSL use its fastest SHA-1 (e.g. SHA-NI) even in FIPS builds.
+    header = type.encode() + b'\x00'
+    sha = hashlib.sha1(header, usedforsecurity=False)
+    sha.update(data)
+    oid = sha.hexdigest()
+    if not write:
+        return oid
+    if defer is not None:
+        defer[oid] = header + data
+        return oid
+    if written is not None:
+        if oid in written:
+            return oid
+        written.add(oid)
+    # Same ID means same content, so an existing object is already correct
+    if object_exists(oid):
+        return oid
+    _write_file(f'{OBJECTS_DIR}/{oid}', [header, data])
     return oid
 
+def _write_file(path, chunks):
+    """
+    Write a list of byte buffers to a file, gathering them into a
+    single `writev` call where the platform has one.
+    The file is written under a temporary name and renamed into place,
+    so readers never see a partly written object. Inside
+    `odb_transaction()` the rename waits until the transaction ends.
+    """
+    tmp_path = _temp_path(path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        try:
+            done = os.writev(fd, chunks) if hasattr(os, 'writev') else 0
+            # Finish off anything a short write left behind
+            for chunk in chunks:
+                view = memoryview(chunk)
+                if done >= len(view):
+                    done -= len(view)
+                    continue
+                view, done = view[done:], 0
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if _odb_pending is not None:
+        _odb_pending[path] = tmp_path
+    else:
+        os.replace(tmp_path, path)
+
+def _temp_path(path):
+    """
+    Return a temporary name next to `path`, unique to this process and thread.
+    """
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+@contextmanager
+def odb_transaction():
+    """
+    Context manager that makes the objects written inside it durable
+    together. The objects stay under their temporary names until the
+    block ends; then each one is synced, they are all renamed into place,
+    and their directory is synced once to make the renames durable.
+    They can still be found and read in the meantime.
+    If the block raises, the objects are discarded.
+    Nested transactions join the outermost one.
+    """
+    global _odb_pending
+    if _odb_pending is not None:
+        yield
+        return
+    
+    _odb_pending = pending = {}
+    try:
+        yield
+    except BaseException:
+        for tmp_path in pending.values():
+            os.remove(tmp_path)
+        raise
+    finally:
+        _odb_pending = None
+    
+    for tmp_path in pending.values():
+        _fsync_path(tmp_path)
+    for path, tmp_path in pending.items():
+        os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        for dirname in {os.path.dirname(path) for path in pending}:
+            _fsync_path(dirname, os.O_DIRECTORY)
+
+def _is_pending(path):
+    """
+    Check if an object is waiting to be renamed into `path` at the end
+    of the current `odb_transaction()`.
+    """
+    return _odb_pending is not None and path in _odb_pending
+
+def _fsync_path(path, flags=0):
+    fd = os.open(path, os.O_RDONLY | flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def hash_file(path, written=None, write=True):
+    """
+    Store a file's content as a blob object and return its object ID.
+    Files of at least MMAP_THRESHOLD bytes are memory-mapped and hashed
+    in place instead of being read into memory first.
+    `written` and `write` are passed through to `hash_object`.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return hash_object(f.read(), written=written, write=write)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return hash_object(content, written=written, write=write)
+
+def write_objects(objects):
+    """
+    Store a batch of objects in `.ugit/objects`.
+
+    :param objects: A dictionary of object IDs to raw objects,
+        as collected by `hash_object(..., defer=objects)`.
+    """
+    existing = stored_object_ids()
+    for oid, obj in objects.items():
+        if oid in existing or _is_pending(f'{OBJECTS_DIR}/{oid}'):
+            continue
+        _write_file(f'{OBJECTS_DIR}/{oid}', [obj])
+
 def get_object (oid, expected ='blob'):
     """
     Retrieve an object by its ID.
     Reads the object from `.ugit/objects/<oid>`, validates its type,
     and returns its content. 
     """
-    with open (f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
-    
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode() 
+    with _object_cache_lock:
+        cached = _object_cache.get(oid)
+        if cached:
+            _object_cache.move_to_end(oid)
+    if cached:
+        type_, content = cached
+    else:
+        obj = _read_object(oid, GIT_DIR)
+        
+        type_, _, content = obj.partition(b'\x00')
+        type_ = type_.decode() 
+        if len(content) <= OBJECT_CACHE_MAX_OBJECT:
+            _cache_object(oid, type_, content)
     
     if expected is not None:
         assert type_ == expected, f'Expected object of type {expected}, got {type_}'
     return content
 
+def _cache_object(oid, type_, content):
+    """
+    Remember a parsed object, evicting the least recently used ones
+    once the cache holds more than OBJECT_CACHE_BYTES of content.
+    """
+    global _object_cache_size
+    with _object_cache_lock:
+        if oid in _object_cache:
+            return
+        _object_cache[oid] = (type_, content)
+        _object_cache_size += len(content)
+        while _object_cache_size > OBJECT_CACHE_BYTES:
+            _, (_, evicted) = _object_cache.popitem(last=False)
+            _object_cache_size -= len(evicted)
+
+def _read_object(oid, git_dir):
+    """
+    Read a raw object (header and content) from a git directory,
+    looking in the packfile first and then among the loose objects.
+    """
+    packed = _find_packed(oid, git_dir)
+    if packed:
+        pack, start, end = packed
+        return pack[start:end]
+    path = f'{git_dir}/objects/{oid}'
+    if _is_pending(path):
+        path = _odb_pending[path]
+    try:
+        with open (path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        # Another process may have packed it since the pack was checked
+        _packs_checked.discard(git_dir)
+        packed = _find_packed(oid, git_dir)
+        if not packed:
+            raise
+        pack, start, end = packed
+        return pack[start:end]
+
+def _load_pack(git_dir):
+    """
+    Load the packfile of a git directory, if it has one.
+
+    The pack is laid out as every object back to back, sorted by object ID,
+    followed by the index: the binary object IDs (20 bytes each), the
+    offsets of each object plus the end of the data (8 bytes each), and
+    finally the object count (8 bytes).
+
+    :return: A tuple (mmap, oids, offsets), or None if there is no pack.
+    """
+    cached = _packs.get(git_dir)
+    if cached and git_dir in _packs_checked:
+        return cached[1]
+    
+    # The same git_dir string can name another repository after a chdir,
+    # and another process may repack, so check the pack is still the
+    # same file before reusing it, once each time the git directory changes
+    path = f'{git_dir}/objects/objects.pack'
+    try:
+        st = os.stat(path)
+        signature = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        signature = None
+    
+    if not cached or cached[0] != signature:
+        pack = None
+        if signature:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            count = array('Q', mm[-8:])[0]
+            offsets_start = len(mm) - 8 - 8 * (count + 1)
+            oids_start = offsets_start - 20 * count
+            pack = (mm, mm[oids_start:offsets_start], array('Q', mm[offsets_start:-8]))
+        cached = _packs[git_dir] = (signature, pack)
+    _packs_checked.add(git_dir)
+    return cached[1]
+
+def _find_packed(oid, git_dir):
+    """
+    Look up an object in the packfile of a git directory.
+
+    :return: A tuple (mmap, start, end) locating the raw object,
+        or None if it isn't packed.
+    """
+    pack = _load_pack(git_dir)
+    if not pack:
+        return None
+    mm, oids, offsets = pack
+    try:
+        key = bytes.fromhex(oid)
+    except ValueError:
+        return None
+    
+    # Binary search over the fixed-width sorted object IDs
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if oids[mid * 20:mid * 20 + 20] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    if oids[lo * 20:lo * 20 + 20] != key:
+        return None
+    return mm, offsets[lo], offsets[lo + 1]
+
+def _packed_object_ids(git_dir):
+    """
+    List the IDs of the objects in the packfile of a git directory.
+    """
+    pack = _load_pack(git_dir)
+    if not pack:
+        return []
+    oids = pack[1]
+    return [oids[i:i + 20].hex() for i in range(0, len(oids), 20)]
+
+def stored_object_ids():
+    """
+    Return the set of IDs of every stored object, loose or packed.
+    Listing them once is much cheaper than calling `object_exists`
+    for each of a large batch of objects.
+    """
+    oids = {name for name in os.listdir(OBJECTS_DIR) if len(name) == 40}
+    oids.update(_packed_object_ids(GIT_DIR))
+    return oids
+
+def pack_objects():
+    """
+    Pack all objects into a single packfile, `.ugit/objects/objects.pack`.
+    Objects already in the pack are carried over, and loose objects
+    are removed once the new pack is in place.
+
+    :return: The number of objects in the pack.
+    """
+    objects_dir = OBJECTS_DIR
+    loose = [name for name in os.listdir(objects_dir) if len(name) == 40]
+    pack = _load_pack(GIT_DIR)
+    oids = sorted(set(loose).union(_packed_object_ids(GIT_DIR)))
+    
+    offsets = array('Q', [0])
+    with open(f'{objects_dir}/objects.pack.tmp', 'wb') as out:
+        for oid in oids:
+            obj = _read_object(oid, GIT_DIR)
+            out.write(obj)
+            offsets.append(offsets[-1] + len(obj))
+        out.write(b''.join(bytes.fromhex(oid) for oid in oids))
+        out.write(offsets.tobytes())
+        out.write(array('Q', [len(oids)]).tobytes())
+    
+    if pack:
+        pack[0].close()
+    _packs.pop(GIT_DIR, None)
+    os.replace(f'{objects_dir}/objects.pack.tmp', f'{objects_dir}/objects.pack')
+    for oid in loose:
+        os.remove(f'{objects_dir}/{oid}')
+    return len(oids)
+
 def iter_refs(prefix='', deref=True):
     """
     Iterate over all references in the repository.
     Yields tuples of (refname, refvalue).
     """
     refs = ['HEAD', 'MERGE_HEAD']
-    for root, _, filesnames in os.walk(f'{GIT_DIR}/refs'):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{names}' for names in filesnames)
+    refs.extend(_list_ref_names('refs'))
     
     for refname in refs:
-        refname = refname.replace('\\', '/')
         if not refname.startswith(prefix):
             continue
         ref = get_ref(refname, deref=deref)
         if ref.value:
             yield refname, ref
 
+def _list_ref_names(dirname):
+    """
+    List the names of the refs stored under a directory of GIT_DIR,
+    using the file types `os.scandir` already knows instead of a stat each.
+    """
+    try:
+        with os.scandir(f'{GIT_DIR}/{dirname}') as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return
+    # Files before subdirectories, in the same order os.walk used
+    subdirs = []
+    for entry in entries:
+        name = f'{dirname}/{entry.name}'
+        if entry.is_dir():
+            subdirs.append(name)
+        elif entry.is_file():
+            yield name
+    for subdir in subdirs:
+        yield from _list_ref_names(subdir)
+
 def delete_ref(ref, deref=True):
     """
     Delete a reference.
@@ -130,6 +505,25 @@ def delete_ref(ref, deref=True):
     """
     ref = _get_ref_internal(ref, deref)[0]
     os.remove(f'{GIT_DIR}/{ref}')
+    _refs_changed()
+
+def refs_generation():
+    """
+    Return a counter that changes every time a ref is updated or deleted,
+    or the git directory is changed (`change_git_dir` may point at another
+    repository, or at one whose refs another process has since changed).
+    Callers can use it to tell when something derived from the refs is stale.
+    """
+    return _ref_generation
+
+def _refs_changed():
+    """
+    Forget every resolved ref, since a symbolic ref may point at the
+    one that changed, and bump the refs generation.
+    """
+    global _ref_generation
+    _ref_cache.clear()
+    _ref_generation += 1
 
 def object_exists(oid):
     """
@@ -138,7 +532,9 @@ def object_exists(oid):
     :param oid: The object ID to check.
     :return: True if the object exists, False otherwise.
     """
-    return os.path.isfile(f'{GIT_DIR}/objects/{oid}')
+    path = f'{OBJECTS_DIR}/{oid}'
+    return (os.path.isfile(path) or _is_pending(path)
+            or _find_packed(oid, GIT_DIR) is not None)
 
 def fetch_objects_if_missing(oid, remote_git_dir):
     """
@@ -150,8 +546,7 @@ def fetch_objects_if_missing(oid, remote_git_dir):
     if object_exists(oid):
         return
     remote_git_dir += '/.ugit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}',
-                f'{GIT_DIR}/objects/{oid}')
+    _copy_object(oid, remote_git_dir, GIT_DIR)
 
 def push_object(oid, remote_git_dir):
     """
@@ -161,10 +556,51 @@ def push_object(oid, remote_git_dir):
     :param remote_git_dir: The remote git directory to push to.
     """
     remote_git_dir += '/.ugit'
-    dest_dir = f'{remote_git_dir}/objects'
-    os.makedirs(dest_dir, exist_ok=True)
-    shutil.copy(f'{GIT_DIR}/objects/{oid}',
-                f'{dest_dir}/{oid}')
+    os.makedirs(f'{remote_git_dir}/objects', exist_ok=True)
+    _copy_object(oid, GIT_DIR, remote_git_dir)
+
+def _copy_object(oid, src_git_dir, dest_git_dir):
+    """
+    Copy an object between git directories as a loose object.
+    Packed objects are extracted from the source pack.
+    """
+    src = f'{src_git_dir}/objects/{oid}'
+    dest = f'{dest_git_dir}/objects/{oid}'
+    if not os.path.isfile(src):
+        _write_file(dest, [_read_object(oid, src_git_dir)])
+        return
+    # Copy under a temporary name, like _write_file, so an interrupted
+    # copy never leaves a truncated object that looks complete
+    tmp_path = _temp_path(dest)
+    try:
+        _fast_copy(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _fast_copy(src, dest):
+    """
+    Copy a file's content, letting the kernel do the copy with
+    `os.copy_file_range` (which can reflink on CoW filesystems)
+    and falling back to `shutil.copyfile` where that isn't possible.
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining:
+                    copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            if not remaining:
+                return
+        except OSError:
+            # e.g. unsupported by the kernel or across filesystems
+            pass
+    shutil.copyfile(src, dest)
 
 @contextmanager
 def get_index():
@@ -181,4 +617,39 @@ def get_index():
     yield index
     
     with open(f'{GIT_DIR}/index', 'w') as f:
-        json.dump(index, f)
\ No newline at end of file
+        json.dump(index, f)
+
+@contextmanager
+def get_stat_cache():
+    """
+    Context manager for the stat cache file.
+    Maps each file path to [mtime_ns, size, inode, oid] as of the last
+    time it was hashed, so unchanged files don't need hashing again.
+    
+    Entries modified at or after the time the cache was last written are
+    left out ("racily clean", as git calls them): on filesystems with
+    coarse timestamps, the file may have been rewritten within the same
+    tick without its stat data changing. The file is only rewritten when
+    the cache changed, so its timestamp keeps marking when entries were
+    last recorded.
+
+    :return: A dictionary representing the stat cache.
+    """
+    path = f'{GIT_DIR}/index_cache'
+    cache, text = {}, None
+    try:
+        with open(path) as f:
+            text = f.read()
+            written_ns = os.fstat(f.fileno()).st_mtime_ns
+    except FileNotFoundError:
+        pass
+    else:
+        cache = {name: entry for name, entry in json.loads(text).items()
+                 if entry[0] < written_ns}
+    
+    yield cache
+    
+    new_text = json.dumps(cache)
+    if new_text != text:
+        with open(path, 'w') as f:
+            f.write(new_text)
@@ -1,54 +1,130 @@
+import os
+import heapq
 import subprocess
+import threading
 
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile as Temp
 
 from . import data
 
+# Blob contents can be handed to `diff` as /dev/fd/N paths on pipes.
+# `diff3` still gets temporary files, since it reads its inputs more than once.
+_HAS_DEV_FD = os.path.isdir('/dev/fd')
+
 def compare_trees (*trees):
     """
     Compare multiple tree dictionaries. 
     Yields tuples of (path, oid1, oid2, ...) for each unique path 
     found in any of the provided trees.
     """
-    entries = defaultdict(lambda: [None] * len(trees))
+    # The trees are dictionaries already, so look paths up in place
+    # rather than regrouping every entry into a new dictionary of lists.
+    # Paths come out in the order they are first seen, as before.
     for i, tree in enumerate(trees):
-        for path, oid in tree.items():
-            entries[path][i] = oid
+        earlier = trees[:i]
+        for path in tree:
+            if not any(path in t for t in earlier):
+                yield (path, *(t.get(path) for t in trees))
+
+def compare_sorted_trees (*trees):
+    """
+    Compare multiple streams of (path, oid) pairs in tree order,
+    as produced by `base.iter_tree`.
+    Yields the same tuples as `compare_trees`, but merges the streams
+    lazily instead of collecting every path into a dictionary first.
+    """
+    def keyed(i, tree):
+        # Tree order sorts by path component, e.g. 'a/b' before 'a.txt'
+        for path, oid in tree:
+            yield path.split('/'), i, path, oid
     
-    for path, oids in entries.items():
-        yield (path, *oids)
+    current, oids = None, None
+    streams = [keyed(i, tree) for i, tree in enumerate(trees)]
+    for _, i, path, oid in heapq.merge(*streams):
+        if path != current:
+            if current is not None:
+                yield (current, *oids)
+            current, oids = path, [None] * len(trees)
+        oids[i] = oid
+    if current is not None:
+        yield (current, *oids)
 
 def diff_trees (t_from, t_to):
     """
     Generate a diff between two tree objects.
-    Compares the files in the two trees and returns a string
-    summarizing the changes (added, removed, modified files).
+    Compares the files in the two trees and yields the diff of each
+    changed file (added, removed, modified) in turn, as bytes, so
+    callers can write it out without holding the whole diff.
     """
-    output = b''
-    for path, o_from, o_to in compare_trees(t_from, t_to):
-        if o_from != o_to:
-            output += diff_blobs(o_from, o_to, path)
-    return output
+    # Each blob diff is its own `diff` process, so run them side by side,
+    # but only a bounded window ahead of the consumer so finished diffs
+    # don't pile up in memory
+    workers = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path, _, o_from, o_to in iter_changes(t_from, t_to):
+            pending.append(executor.submit(diff_blobs, o_from, o_to, path))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 def diff_blobs (o_from, o_to, path='blob'):
     """
     Generate a diff between two blob objects.
     Uses the system `diff` command to compute the differences
     between the contents of the two blobs.   
+    Where the system has `/dev/fd`, the contents are streamed to `diff`
+    through pipes instead of being written to temporary files.
     """
-    with Temp() as f_from, Temp() as f_to:
-        for oid, f in [(o_from, f_from), (o_to, f_to)]:
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-        
-        with subprocess.Popen(
-            ['diff', '--unified', '--show-c-function', '--label', f'a/{path}', f_from.name, '--label', f'b/{path}', f_to.name],
-            stdout=subprocess.PIPE
-        ) as proc:
-            output, _ = proc.communicate()
-        return output
+    if not _HAS_DEV_FD:
+        with Temp() as f_from, Temp() as f_to:
+            for oid, f in [(o_from, f_from), (o_to, f_to)]:
+                if oid:
+                    f.write(data.get_object(oid))
+                    f.flush()
+            return _run_diff(path, f_from.name, f_to.name)
+    
+    fds, writers = [], []
+    try:
+        for oid in (o_from, o_to):
+            read_fd, write_fd = os.pipe()
+            fds.append(read_fd)
+            writer = threading.Thread(
+                target=_write_pipe,
+                args=(write_fd, data.get_object(oid) if oid else b''))
+            writer.start()
+            writers.append(writer)
+        return _run_diff(path, *(f'/dev/fd/{fd}' for fd in fds), pass_fds=fds)
+    finally:
+        for fd in fds:
+            os.close(fd)
+        for writer in writers:
+            writer.join()
+
+def _run_diff(path, name_from, name_to, pass_fds=()):
+    """
+    Run `diff` on two files and return its output.
+    """
+    with subprocess.Popen(
+        ['diff', '--unified', '--show-c-function', '--label', f'a/{path}', name_from, '--label', f'b/{path}', name_to],
+        stdout=subprocess.PIPE, pass_fds=pass_fds
+    ) as proc:
+        output, _ = proc.communicate()
+    return output
+
+def _write_pipe(fd, content):
+    """
+    Write content into a pipe and close it. Stops quietly if the reader
+    goes away early.
+    """
+    try:
+        with open(fd, 'wb') as f:
+            f.write(content)
+    except BrokenPipeError:
+        pass
 
 def iter_changed_files(t_from, t_to):
     """
@@ -58,23 +134,34 @@ def iter_changed_files(t_from, t_to):
     :param t_to: The to tree.
     :return: A generator of (path, action) tuples.
     """
+    for path, action, _, _ in iter_changes(t_from, t_to):
+        yield path, action
+
+def iter_changes(t_from, t_to):
+    """
+    Iterate over the changes between two trees in a single pass.
+
+    :param t_from: The from tree.
+    :param t_to: The to tree.
+    :return: A generator of (path, action, from oid, to oid) tuples.
+    """
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
             action = ('new file' if not o_from else 'deleted' if not o_to else 'modified')
-            yield path, action
+            yield path, action, o_from, o_to
 
 def merge_trees(t_base, t_HEAD, t_other):
     """
     Merge three trees.
 
-    :param t_base: The base tree.
-    :param t_HEAD: The HEAD tree.
-    :param t_other: The other tree.
+    :param t_base: The base tree, as (path, oid) pairs in tree order.
+    :param t_HEAD: The HEAD tree, as (path, oid) pairs in tree order.
+    :param t_other: The other tree, as (path, oid) pairs in tree order.
     :return: The merged tree.
     """
     tree = {}
-    for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = data.hash_objects(merge_blobs(o_base, o_HEAD, o_other))
+    for path, o_base, o_HEAD, o_other in compare_sorted_trees(t_base, t_HEAD, t_other):
+        tree[path] = data.hash_object(merge_blobs(o_base, o_HEAD, o_other))
     return tree
 
 def merge_blobs(o_base, o_HEAD, o_other):
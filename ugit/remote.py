@@ -1,4 +1,7 @@
 import os
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
 
 from . import data, base
 
@@ -13,8 +16,16 @@ def fetch(remote_path):
     """
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
     
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_objects_if_missing(oid, remote_path)
+    # Walk the remote's history where every object is available, so the
+    # copies don't have to wait on the walk and can run side by side
+    with data.change_git_dir(remote_path):
+        oids = list(base.iter_objects_in_commits(refs.values()))
+    # One directory listing instead of a stat per object
+    existing = data.stored_object_ids()
+    missing = [oid for oid in oids if oid not in existing]
+    copy = functools.partial(data.fetch_objects_if_missing, remote_git_dir=remote_path)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(copy, missing))
     
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
@@ -47,12 +58,14 @@ def push(remote_path, refname):
     
     know_remote_refs = filter(data.object_exists, remote_refs.values())
     remote_objects = set(base.iter_objects_in_commits(know_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    
-    objects_to_push = local_objects - remote_objects
+    # Stream the local objects past the remote set rather than
+    # collecting them into a second set just to subtract
+    objects_to_push = (oid for oid in base.iter_objects_in_commits({local_ref})
+                       if oid not in remote_objects)
     
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    copy = functools.partial(data.push_object, remote_git_dir=remote_path)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(copy, objects_to_push))
     
     with data.change_git_dir(remote_path):
         data.update_ref(refname, data.RefValue(symbolic=False, value=local_ref))
\ No newline at end of file